@@ -10,7 +10,7 @@ from typing import Dict
 from diffusers.loaders import PeftAdapterMixin
 from timm.models.vision_transformer import PatchEmbed, Attention, Mlp
 from huggingface_hub import snapshot_download
-from safetensors.torch import load_file
+from safetensors import safe_open
 from accelerate import init_empty_weights
 
 from OmniGen.transformer import Phi3Config, Phi3Transformer
@@ -204,7 +204,12 @@ class OmniGen(nn.Module, PeftAdapterMixin):
             ckpt = torch.load(model_path, map_location='cpu')
         else:
             print("Loading safetensors")
-            ckpt = load_file(model_path, 'cpu')
+            # cast each tensor while reading the mmapped file, so the full precision
+            # checkpoint is never materialized in RAM next to the converted one
+            ckpt = {}
+            with safe_open(model_path, framework="pt", device="cpu") as f:
+                for key in f.keys():
+                    ckpt[key] = f.get_tensor(key).to(dtype)
 
         if low_cpu_mem_usage:
             with init_empty_weights():
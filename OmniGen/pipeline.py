@@ -148,6 +148,7 @@ class OmniGenPipeline:
         offload_model: bool = False,
         use_kv_cache: bool = True,
         offload_kv_cache: bool = True,
+        kv_cache_dtype: str = None,
         use_input_image_size_as_output: bool = False,
         dtype: torch.dtype = torch.bfloat16,
         seed: int = None,
@@ -160,7 +161,7 @@ class OmniGenPipeline:
             prompt (`str` or `List[str]`):
                 The prompt or prompts to guide the image generation. 
             input_images (`List[str]` or `List[List[str]]`, *optional*):
-                The list of input images. We will replace the "<|image_i|>" in prompt with the 1-th image in list.
+                The list of input images, as file paths or PIL images. We will replace the "<|image_i|>" in prompt with the 1-th image in list.
             height (`int`, *optional*, defaults to 1024):
                 The height in pixels of the generated image. The number must be a multiple of 16.
             width (`int`, *optional*, defaults to 1024):
@@ -182,6 +183,7 @@ class OmniGenPipeline:
                 Perform inference on images with different guidance separately; this can save memory when generating images of large size at the expense of slower inference.
             use_kv_cache (`bool`, *optional*, defaults to True): enable kv cache to speed up the inference
             offload_kv_cache (`bool`, *optional*, defaults to True): offload the cached key and value to cpu, which can save memory but slow down the generation silightly
+            kv_cache_dtype (`str`, *optional*): store the cached key and value in a lower precision, e.g. "fp8_e4m3", which halves the kv cache memory and offload traffic
             offload_model (`bool`, *optional*, defaults to False): offload the model to cpu, which can save memory but slow down the generation
             use_input_image_size_as_output (bool, defaults to False): whether to use the input image size as the output image size, which can be used for single-image input, e.g., image editing task
             seed (`int`, *optional*):
@@ -281,7 +283,7 @@ class OmniGenPipeline:
         #     self.model.to(self.device)
 
         scheduler = OmniGenScheduler(num_steps=num_inference_steps)
-        samples = scheduler(latents, func, model_kwargs, use_kv_cache=use_kv_cache, offload_kv_cache=offload_kv_cache)
+        samples = scheduler(latents, func, model_kwargs, use_kv_cache=use_kv_cache, offload_kv_cache=offload_kv_cache, kv_cache_dtype=kv_cache_dtype)
         samples = samples.chunk((1+num_cfg), dim=0)[0]
 
         if self.model_cpu_offload:
@@ -313,7 +315,6 @@ class OmniGenPipeline:
             for i, sample in enumerate(output_samples):
                 output_images.append(Image.fromarray(sample))
 
-        empty_cache() # Clear VRAM
         gc.collect()              # Run garbage collection to free system RAM
 
         return output_images
\ No newline at end of file
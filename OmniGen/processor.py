@@ -49,7 +49,9 @@ class OmniGenProcessor:
 
 
     def process_image(self, image):
-        image = Image.open(image).convert('RGB')
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        image = image.convert('RGB')
         return self.image_transform(image)
     
     def process_multi_modal_prompt(self, text, input_images):
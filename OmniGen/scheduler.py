@@ -5,13 +5,26 @@ import gc
 import torch
 from transformers.cache_utils import Cache, DynamicCache, OffloadedCache
 
+from OmniGen.utils import PinnedMemoryPool
+
+
+
+KV_CACHE_DTYPES = {
+    "fp8_e4m3": torch.float8_e4m3fn,
+}
 
 
 class OmniGenCache(DynamicCache):
-    def __init__(self, num_tokens_for_img: int, offload_kv_cache: bool=False) -> None:
+    def __init__(self, num_tokens_for_img: int, offload_kv_cache: bool=False, kv_cache_dtype: Optional[str]=None) -> None:
         super().__init__()
         self.original_device = []
+        # per-layer scales and compute dtype, only used when the cache is stored quantized
+        self.key_scale = []
+        self.value_scale = []
+        self.original_dtype = []
+        self.kv_cache_dtype = KV_CACHE_DTYPES[kv_cache_dtype] if kv_cache_dtype is not None else None
         self.prefetch_stream = torch.cuda.Stream()
+        self.pinned_pool = PinnedMemoryPool()
         self.num_tokens_for_img = num_tokens_for_img
         if not torch.cuda.is_available():
             print("No avaliable GPU, offload_kv_cache wiil be set to False, which will result in large memory usage and time cost when input multiple images!!!")
@@ -19,14 +32,30 @@ class OmniGenCache(DynamicCache):
         else:
             self.offload_kv_cache = offload_kv_cache
 
+    def quantize(self, x: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        "Quantizes a tensor to the cache dtype with a per-tensor scale"
+        if self.kv_cache_dtype is None:
+            return x, None
+        fp8_max = torch.finfo(self.kv_cache_dtype).max
+        # stays in the compute dtype, the floor keeps the scale nonzero once cast to fp16
+        scale = (x.abs().amax().float() / fp8_max).clamp(min=torch.finfo(x.dtype).tiny)
+        x = (x / scale.to(x.dtype)).clamp_(-fp8_max, fp8_max).to(self.kv_cache_dtype)
+        return x, scale
+
+    def dequantize(self, x: torch.Tensor, scale: Optional[torch.Tensor], dtype: torch.dtype) -> torch.Tensor:
+        "Restores a cached tensor to the compute dtype"
+        if scale is None:
+            return x
+        return x.to(dtype) * scale.to(dtype)
+
     def prefetch_layer(self, layer_idx: int):
         "Starts prefetching the next layer cache"
         if layer_idx < len(self):
             with torch.cuda.stream(self.prefetch_stream):
                 # Prefetch next layer tensors to GPU
                 device = self.original_device[layer_idx]
-                self.key_cache[layer_idx] = self.key_cache[layer_idx].to(device, non_blocking=True)
-                self.value_cache[layer_idx] = self.value_cache[layer_idx].to(device, non_blocking=True)
+                self.key_cache[layer_idx], self.value_cache[layer_idx] = self.pinned_pool.load(
+                    layer_idx, [self.key_cache[layer_idx], self.value_cache[layer_idx]], device)
 
     def evict_previous_layer(self, layer_idx: int):
         "Moves the previous layer cache to the CPU"
@@ -36,8 +65,8 @@ class OmniGenCache(DynamicCache):
                 prev_layer_idx = -1
             else:
                 prev_layer_idx = (layer_idx - 1) % len(self)
-            self.key_cache[prev_layer_idx] = self.key_cache[prev_layer_idx].to("cpu", non_blocking=True)
-            self.value_cache[prev_layer_idx] = self.value_cache[prev_layer_idx].to("cpu", non_blocking=True)
+            self.key_cache[prev_layer_idx], self.value_cache[prev_layer_idx] = self.pinned_pool.offload(
+                prev_layer_idx % len(self), [self.key_cache[prev_layer_idx], self.value_cache[prev_layer_idx]])
 
 
     def __getitem__(self, layer_idx: int) -> List[Tuple[torch.Tensor]]:
@@ -51,6 +80,7 @@ class OmniGenCache(DynamicCache):
                 original_device = self.original_device[layer_idx]
                 # self.prefetch_stream.synchronize(original_device)
                 torch.cuda.synchronize(self.prefetch_stream)
+                self.pinned_pool.release_loaded()
                 key_tensor = self.key_cache[layer_idx]
                 value_tensor = self.value_cache[layer_idx]
                 
@@ -59,6 +89,9 @@ class OmniGenCache(DynamicCache):
             else:
                 key_tensor = self.key_cache[layer_idx]
                 value_tensor = self.value_cache[layer_idx]
+            dtype = self.original_dtype[layer_idx]
+            key_tensor = self.dequantize(key_tensor, self.key_scale[layer_idx], dtype)
+            value_tensor = self.dequantize(value_tensor, self.value_scale[layer_idx], dtype)
             return (key_tensor, value_tensor)
         else:
             raise KeyError(f"Cache only has {len(self)} layers, attempted to access layer with index {layer_idx}")
@@ -97,12 +130,19 @@ class OmniGenCache(DynamicCache):
             if layer_idx == 0:
                 self._seen_tokens += key_states.shape[-2]
                 
-            self.key_cache.append(key_states)
-            self.value_cache.append(value_states)
+            # the condition tokens never change after the first step, so a per-tensor scale
+            # computed here covers every later read of this layer
+            key_cached, key_scale = self.quantize(key_states)
+            value_cached, value_scale = self.quantize(value_states)
+            self.key_cache.append(key_cached)
+            self.value_cache.append(value_cached)
+            self.key_scale.append(key_scale)
+            self.value_scale.append(value_scale)
+            self.original_dtype.append(key_states.dtype)
             self.original_device.append(key_states.device)
             if self.offload_kv_cache:
                 self.evict_previous_layer(layer_idx)
-            return self.key_cache[layer_idx], self.value_cache[layer_idx]
+            return key_states, value_states
         else:
             # only cache the states for condition tokens
             key_tensor, value_tensor = self[layer_idx]
@@ -151,12 +191,12 @@ class OmniGenScheduler:
         
         return cache
 
-    def __call__(self, z, func, model_kwargs, use_kv_cache: bool=True, offload_kv_cache: bool=True):
+    def __call__(self, z, func, model_kwargs, use_kv_cache: bool=True, offload_kv_cache: bool=True, kv_cache_dtype: Optional[str]=None):
         num_tokens_for_img = z.size(-1)*z.size(-2) // 4
         if isinstance(model_kwargs['input_ids'], list):
-            cache = [OmniGenCache(num_tokens_for_img, offload_kv_cache) for _ in range(len(model_kwargs['input_ids']))] if use_kv_cache else None
+            cache = [OmniGenCache(num_tokens_for_img, offload_kv_cache, kv_cache_dtype) for _ in range(len(model_kwargs['input_ids']))] if use_kv_cache else None
         else:
-            cache = OmniGenCache(num_tokens_for_img, offload_kv_cache) if use_kv_cache else None
+            cache = OmniGenCache(num_tokens_for_img, offload_kv_cache, kv_cache_dtype) if use_kv_cache else None
         results = {}
         for i in tqdm(range(self.num_steps)):
             timesteps = torch.zeros(size=(len(z), )).to(z.device) + self.sigma[i]
@@ -175,7 +215,6 @@ class OmniGenScheduler:
                 model_kwargs['attention_mask'] = self.crop_attention_mask_for_cache(model_kwargs['attention_mask'], num_tokens_for_img)
 
         del cache
-        torch.cuda.empty_cache()  
         gc.collect()
         return z
 
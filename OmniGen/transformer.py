@@ -19,6 +19,8 @@ from transformers import Phi3Config, Phi3Model
 from transformers.cache_utils import Cache, DynamicCache, StaticCache
 from transformers.utils import logging
 
+from OmniGen.utils import PinnedMemoryPool
+
 logger = logging.get_logger(__name__)
 
 
@@ -33,19 +35,23 @@ class Phi3Transformer(Phi3Model):
         "Starts prefetching the next layer cache"
         with torch.cuda.stream(self.prefetch_stream):
             # Prefetch next layer tensors to GPU
-            for name, param in self.layers[layer_idx].named_parameters():
-                param.data = param.data.to(device, non_blocking=True)
+            params = list(self.layers[layer_idx].parameters())
+            for param, data in zip(params, self.pinned_pool.load(layer_idx, [p.data for p in params], device)):
+                param.data = data
 
     def evict_previous_layer(self, layer_idx: int):
         "Moves the previous layer cache to the CPU"
         prev_layer_idx = layer_idx - 1
-        for name, param in self.layers[prev_layer_idx].named_parameters():
-            param.data = param.data.to("cpu", non_blocking=True)
+        params = list(self.layers[prev_layer_idx].parameters())
+        for param, data in zip(params, self.pinned_pool.offload(prev_layer_idx % len(self.layers), [p.data for p in params])):
+            param.data = data
             
     def get_offlaod_layer(self, layer_idx: int, device: torch.device):
         # init stream
         if not hasattr(self, "prefetch_stream"):
             self.prefetch_stream = torch.cuda.Stream()
+        if not hasattr(self, "pinned_pool"):
+            self.pinned_pool = PinnedMemoryPool()
 
         # delete previous layer
         torch.cuda.current_stream().synchronize()
@@ -53,6 +59,7 @@ class Phi3Transformer(Phi3Model):
         
         # make sure the current layer is ready
         torch.cuda.synchronize(self.prefetch_stream)
+        self.pinned_pool.release_loaded()
 
         # load next layer
         self.prefetch_layer((layer_idx + 1) % len(self.layers), device)
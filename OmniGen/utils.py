@@ -1,4 +1,5 @@
 import logging
+from typing import Any, Dict, List
 
 from PIL import Image
 import torch
@@ -21,6 +22,65 @@ def empty_cache():
         torch.cuda.empty_cache()
         
         
+class PinnedMemoryPool:
+    """
+    Reusable page-locked CPU buffers for offloading. Each group of tensors (e.g. one layer) is
+    carved out of a single pinned slab, so the host allocator's power-of-two rounding is paid
+    once per group instead of once per tensor. Slabs are recycled by their exact byte size.
+    """
+    def __init__(self):
+        self.slabs: Dict[int, List[torch.Tensor]] = {}
+        self.resident: Dict[Any, torch.Tensor] = {}
+        self.in_flight: List[torch.Tensor] = []
+
+    def offload(self, key, tensors):
+        "Copies a group of tensors into one pinned slab, the copies are queued on the current stream"
+        if all(t.device.type == "cpu" and t.is_pinned() for t in tensors):
+            return tensors
+        # a slab still registered for this group was left behind by tensors moved off it elsewhere
+        stale = self.resident.pop(key, None)
+        if stale is not None:
+            self.slabs.setdefault(stale.numel(), []).append(stale)
+
+        # tensor subclasses (e.g. torchao's quantized weights) are not a plain run of bytes,
+        # they keep their own CPU copy
+        offsets, nbytes = [], 0
+        for t in tensors:
+            if type(t) is torch.Tensor:
+                offsets.append(nbytes)
+                nbytes += (t.numel() * t.element_size() + 63) // 64 * 64
+            else:
+                offsets.append(None)
+        slab = None
+        if nbytes:
+            bucket = self.slabs.get(nbytes)
+            slab = bucket.pop() if bucket else torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+            self.resident[key] = slab
+
+        buffers = []
+        for t, offset in zip(tensors, offsets):
+            if offset is None:
+                buffers.append(t.to("cpu", non_blocking=True))
+                continue
+            buffer = slab[offset: offset + t.numel() * t.element_size()].view(t.dtype).view(t.shape)
+            buffer.copy_(t, non_blocking=True)
+            buffers.append(buffer)
+        return buffers
+
+    def load(self, key, tensors, device):
+        "Copies a group of tensors to `device`, its slab is recycled by the next `release_loaded`"
+        slab = self.resident.pop(key, None)
+        if slab is not None:
+            self.in_flight.append(slab)
+        return [t.to(device, non_blocking=True) for t in tensors]
+
+    def release_loaded(self):
+        "Returns the slabs of finished loads to the pool, only call once the copy stream is synchronized"
+        for slab in self.in_flight:
+            self.slabs.setdefault(slab.numel(), []).append(slab)
+        self.in_flight = []
+        
+        
 def create_logger(logging_dir):
     """
     Create a logger that writes to a log file and stdout.
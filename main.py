@@ -1,45 +1,98 @@
 import sys
+import re
 import os.path as osp
 import os
+import importlib.util
+
+# Use the Rust-backed parallel downloader for the multi-GB checkpoints when available.
+# Must be set before huggingface_hub is imported, which reads it once at import time.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import numpy as np
 from PIL import Image
 from huggingface_hub import snapshot_download
-import requests
-import tempfile
-import shutil
-import json
-import uuid
-
+import gc
+import functools
+import contextlib
+try:
+    import orjson as json_impl
+except ImportError:
+    import json as json_impl
 
 # Define all path constants
 class Paths:
     ROOT_DIR = osp.dirname(__file__)
     MODELS_DIR = osp.join(ROOT_DIR, "models")
     VAE_PATH = osp.join(ROOT_DIR, "models", "vae")
-    TMP_DIR = osp.join(ROOT_DIR, "tmp")
     MODEL_FILE_FP16 = osp.join(MODELS_DIR, "Shitao-OmniGen-v1", "model.safetensors")
 
+# Probe the available devices once instead of on every call
+_HAS_CUDA = torch.cuda.is_available()
+_HAS_MPS = bool(getattr(torch.backends, "mps", None) and torch.backends.mps.is_available())
+_DEVICE = "cuda" if _HAS_CUDA else ("mps" if _HAS_MPS else "cpu")
+
+# Opt-in diagnostics, VRAM queries go through the CUDA driver on every call
+_LOG_VRAM = _HAS_CUDA and os.environ.get("OMNIGEN_LOG_VRAM") == "1"
+_LOG_INIT = os.environ.get("OMNIGEN_LOG_INIT") == "1"
+# OMNIGEN_COMPILE=0 keeps the denoiser eager, e.g. where Triton is missing or broken
+_COMPILE = os.environ.get("OMNIGEN_COMPILE", "1") != "0"
+
 # Ensure necessary directories exist
 os.makedirs(Paths.MODELS_DIR, exist_ok=True)
 sys.path.append(Paths.ROOT_DIR)
 
 
+@functools.cache
+def _cuda_capability():
+    """Compute capability of the CUDA device, queried on first use since it initializes a CUDA context"""
+    return torch.cuda.get_device_capability() if _HAS_CUDA else (0, 0)
+
+
+@functools.cache
+def _fp8_unsupported_reason():
+    """Why the torchao FP8 compute path can't be used here, None if it can"""
+    if not _HAS_CUDA or _cuda_capability() < (8, 9):
+        return "FP8 compute requires an SM89+ GPU"
+    # rowwise-scaled torch._scaled_mm only exists from torch 2.5
+    if tuple(int(v) for v in torch.__version__.split(".")[:2]) < (2, 5):
+        return f"FP8 rowwise compute requires torch>=2.5, found {torch.__version__}"
+    if importlib.util.find_spec("torchao") is None:
+        return "torchao FP8 quantization unavailable (pip install torchao)"
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _load_presets():
+    """Load preset prompts from data.json once per process"""
+    try:
+        with open(osp.join(Paths.ROOT_DIR, "data.json"), 'rb') as f:
+            data = json_impl.loads(f.read())
+            return data.get("PRESET_PROMPTS", {"None": ""})
+    except FileNotFoundError:
+        return {"None": ""}
+    except Exception as e:
+        print(f"Error loading preset prompts: {e}")
+        return {"None": ""}
+
+
 class OmniGenInference:
     _model_instance = None
+    _current_precision = None
+    # eager and compiled denoiser LLM of the cached pipeline, picked per call
+    _eager_llm = None
+    _compiled_llm = None
+    # whether the compiled LLM already finished a generation, until then failures fall back to eager
+    _compiled_ok = False
+    # "image_1"/"image1" references in the prompt, but not ones already inside an <|image_n|> tag
+    _IMG_RE = re.compile(r"(?<!<\|)image_?([1-3])\b")
+    # Compute dtype per precision, FP8 keeps bf16 activations around the FP8 matmuls
+    _PRECISION_DTYPES = {"BF16": torch.bfloat16, "FP16": torch.float16, "FP8": torch.bfloat16}
     
     # Load preset prompts
-    try:
-        json_path = osp.join(osp.dirname(__file__), "data.json")
-        if osp.exists(json_path):
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                PRESET_PROMPTS = data.get("PRESET_PROMPTS", {"None": ""})
-        else:
-            PRESET_PROMPTS = {"None": ""}
-    except Exception as e:
-        print(f"Error loading preset prompts: {e}")
-        PRESET_PROMPTS = {"None": ""}
+    PRESET_PROMPTS = _load_presets()
 
     def __init__(self):
         self._ensure_model_exists()
@@ -48,27 +101,25 @@ class OmniGenInference:
             from OmniGen import OmniGenPipeline
             self.OmniGenPipeline = OmniGenPipeline
             
-            self.device = "cpu"
-            if torch.backends.mps.is_available():
-                self.device = "mps"
-            if torch.cuda.is_available():
-                self.device = "cuda"
+            self.device = _DEVICE
                 
         except ImportError as e:
             print(f"Error importing OmniGen: {e}")
             raise RuntimeError("Failed to import OmniGen. Please check if the code was downloaded correctly.")
 
     def _empty_cache(self):
-        if torch.backends.mps.is_available():
+        if _HAS_MPS:
             torch.mps.empty_cache()
-        if torch.cuda.is_available():
+        if _HAS_CUDA:
             torch.cuda.empty_cache()
 
     def _ensure_model_exists(self):
         """Ensure model file exists, download if not"""
         try:
-            os.makedirs(Paths.MODELS_DIR, exist_ok=True)
-            
+            # MODELS_DIR is created at import, stat each model path only once
+            fp16_exists = osp.exists(Paths.MODEL_FILE_FP16)
+            vae_exists = osp.exists(Paths.VAE_PATH)
+
             # # Download BNB4 model if specified and not exists
             # if model_precision == "BNB4" and not osp.exists(Paths.MODEL_FILE_BNB4):
             #     print("BNB4 model not found, downloading from Hugging Face...")
@@ -83,7 +134,7 @@ class OmniGenInference:
             #     print("BNB4 model downloaded successfully")
                 
             # Check if FP16 model exists
-            if not osp.exists(Paths.MODEL_FILE_FP16):
+            if not fp16_exists:
                 print("FP16 model not found, starting download from Hugging Face...")
                 snapshot_download(
                     repo_id="Shitao/OmniGen-v1",
@@ -95,13 +146,13 @@ class OmniGenInference:
                 )
                 print("FP16 model downloaded successfully")
             
-            # Verify model files exist after download
-            # if model_precision == "BNB4" and not osp.exists(Paths.MODEL_FILE_BNB4):
-            #     raise RuntimeError("BNB4 model download failed")
-            if not osp.exists(Paths.MODEL_FILE_FP16):
-                raise RuntimeError("FP16 model download failed")
+                # Verify model files exist after download
+                # if model_precision == "BNB4" and not osp.exists(Paths.MODEL_FILE_BNB4):
+                #     raise RuntimeError("BNB4 model download failed")
+                if not osp.exists(Paths.MODEL_FILE_FP16):
+                    raise RuntimeError("FP16 model download failed")
             
-            if not os.path.exists(Paths.VAE_PATH):
+            if not vae_exists:
                 print(f"No VAE found, downloading stabilityai/sdxl-vae from HF")
                 snapshot_download(
                     repo_id="stabilityai/sdxl-vae",
@@ -117,22 +168,22 @@ class OmniGenInference:
             print(f"Error during model initialization: {e}")
             raise RuntimeError(f"Failed to initialize OmniGen model: {str(e)}")
 
-    def _setup_temp_dir(self):
-        """Set up temporary directory with unique name"""
-        self._temp_dir = osp.join(Paths.TMP_DIR, str(uuid.uuid4()))
-        os.makedirs(self._temp_dir, exist_ok=True)
-
-    def _cleanup_temp_dir(self):
-        """Clean up temporary directory"""
-        if hasattr(self, '_temp_dir') and osp.exists(self._temp_dir):
-            shutil.rmtree(self._temp_dir)
+    def save_input_img(self, image):
+        """Convert an IMAGE tensor to a PIL image the pipeline can consume directly"""
+        # multiply/clamp/cast on the tensor's own device, so a GPU image only crosses
+        # to the host as uint8 (a quarter of the float bytes) and no float32 numpy copy is made
+        arr = image[0].mul(255).clamp_(0, 255).to(torch.uint8).contiguous()
+        arr = arr.cpu().numpy()
+        return Image.fromarray(arr)
 
     @classmethod
     def INPUT_TYPES(s):
         return {
             "required": {
                 "prompt": ("STRING", {"multiline": True, "forceInput": False, "default": ""}),
+                "model_precision": (["Auto", "BF16", "FP16", "FP8"], {"default": "Auto"}),
                 "offload_model": ("BOOLEAN", {"default": False}),
+                "kv_cache_dtype": (["auto", "none", "fp8_e4m3"], {"default": "auto"}),
                 "guidance_scale": ("FLOAT", {"default": 3.5, "min": 1.0, "max": 5.0, "step": 0.1, "round": 0.01}),
                 "img_guidance_scale": ("FLOAT", {"default": 1.8, "min": 1.0, "max": 2.0, "step": 0.1, "round": 0.01}),
                 "num_inference_steps": ("INT", {"default": 50, "min": 1, "max": 100, "step": 1}),
@@ -150,39 +201,97 @@ class OmniGenInference:
             }
         }
 
-    def _process_prompt_and_images(self, prompt, images):
-        """Process prompt and images, return updated prompt and image paths"""
+    def _snap_image_size(self, img, max_input_image_size):
+        """Shrink an input image to fit max_input_image_size, then center-crop its sides to a 64 pixel grid"""
+        w, h = img.size
+        if max(w, h) > max_input_image_size:
+            # keep the aspect ratio like crop_arr does, never upscale
+            scale = max_input_image_size / max(w, h)
+            img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+            w, h = img.size
+        # sides below 64 are left to crop_arr, which trims them to its 16 pixel grid
+        cw = w // 64 * 64 if w >= 64 else w
+        ch = h // 64 * 64 if h >= 64 else h
+        if (cw, ch) != (w, h):
+            left, top = (w - cw) // 2, (h - ch) // 2
+            img = img.crop((left, top, left + cw, top + ch))
+        return img
+
+    def _process_prompt_and_images(self, prompt, images, max_input_image_size=1024, use_input_image_size_as_output=False):
+        """Process prompt and images, return updated prompt and images"""
         input_images = []
-        
-        # Auto-generate prompt if empty but images provided
-        if not prompt and any(images):
-            prompt = " ".join(f"<img><|image_{i+1}|></img>" for i, img in enumerate(images) if img is not None)
-        
-        # Process each image
+        images = images or []
+        provided = {i for i, img in enumerate(images, 1) if img is not None}
+
+        # Replace every image reference in a single pass
+        prompt = self._IMG_RE.sub(
+            lambda m: f"<img><|image_{m.group(1)}|></img>" if int(m.group(1)) in provided else m.group(0),
+            prompt,
+        )
+
+        # Process each image, appending tags for images the prompt never mentions
+        # (this also builds the whole prompt when it is empty)
         for i, img in enumerate(images, 1):
             if img is not None:
+                if isinstance(img, torch.Tensor):
+                    img = self.save_input_img(img)
+                elif not isinstance(img, Image.Image):
+                    img = Image.open(img)
+                # fewer distinct input sizes means fewer VAE encode shapes for cuDNN to autotune,
+                # but leave the size alone when the output has to match the input image
+                if not use_input_image_size_as_output:
+                    img = self._snap_image_size(img, max_input_image_size)
                 input_images.append(img)
                 img_tag = f"<img><|image_{i}|></img>"
-                if f"image_{i}" in prompt:
-                    prompt = prompt.replace(f"image_{i}", img_tag)
-                elif f"image{i}" in prompt:
-                    prompt = prompt.replace(f"image{i}", img_tag)
-                elif img_tag not in prompt:
+                if img_tag not in prompt:
                     prompt += f" {img_tag}"
         return prompt.strip(), input_images
 
-    def _check_sdpa_support(self):
-        """Check if system supports Scaled Dot Product Attention"""
-        try:
-            import torch
-            if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
-                return True
+    def _auto_select_precision(self):
+        """Pick the model precision from the GPU capabilities and VRAM"""
+        if not _HAS_CUDA:
+            # the pipeline's default dtype, fp16 kernels are poorly covered on CPU
+            return "BF16"
+        vram_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+        if vram_gb < 8 and _fp8_unsupported_reason() is None:
+            return "FP8"
+        # same tensor-core throughput as fp16 on SM80+, without the overflow risk. Older GPUs
+        # only emulate bf16 (is_bf16_supported() still says True there), so use fp16 on them
+        if _cuda_capability() >= (8, 0):
+            return "BF16"
+        return "FP16"
+
+    def _quantize_fp8(self, pipe):
+        """Convert the transformer linears to FP8 E4M3 W8A8 matmuls via torchao, return whether it was applied"""
+        reason = _fp8_unsupported_reason()
+        if reason is not None:
+            # the FP8 entry of _PRECISION_DTYPES is bf16, which is what the unquantized model runs in
+            print(f"{reason}, running in BF16")
             return False
+        from torchao.quantization import quantize_, Float8DynamicActivationFloat8WeightConfig, PerRow
+
+        quantize_(pipe.model, Float8DynamicActivationFloat8WeightConfig(granularity=PerRow()))
+        return True
+
+    def _compile_model(self, pipe, fp8=False):
+        """Compile the denoiser LLM, return the compiled module or None when not compiling"""
+        if not _HAS_CUDA or not _COMPILE:
+            return None
+        # Compile the LLM rather than pipe.model, forward_with_cfg calls self.forward directly
+        # and would bypass a wrapper around the whole model. The sequence length follows the
+        # prompt length, so dynamic shapes stay allowed, and no CUDA graphs since the KV cache
+        # reads outputs of earlier steps that a graph replay would overwrite.
+        # The offloaded KV cache syncs CUDA streams in every layer, which breaks the graph
+        # there, so only the code between those syncs gets fused.
+        mode = "max-autotune-no-cudagraphs" if fp8 else "default"
+        try:
+            return torch.compile(pipe.model.llm, mode=mode)
         except Exception as e:
-            print(f"Error checking SDPA support: {e}")
-            return False
+            # e.g. "Windows not yet supported for torch.compile"
+            print(f"Warning: torch.compile unavailable, running eagerly: {e}")
+            return None
 
-    def _get_pipeline(self):
+    def _get_pipeline(self, model_precision="BF16"):
         try:
             # Reuse existing instance if available
             if self._model_instance:
@@ -204,38 +313,25 @@ class OmniGenInference:
                 if pipe is None:
                     raise RuntimeError("Initial pipeline creation failed")
                     
-                # Save original pipeline reference before moving to device
-                original_pipe = pipe
-                    
-                # Move to device
-                device = self.device
+                # Move to device, OmniGenPipeline.to moves the model and vae in place
                 try:
-                    # Move model components first
-                    if hasattr(pipe, 'text_encoder'):
-                        pipe.text_encoder = pipe.text_encoder.to(device)
-                    if hasattr(pipe, 'unet'):
-                        pipe.unet = pipe.unet.to(device)
-                    if hasattr(pipe, 'vae'):
-                        pipe.vae = pipe.vae.to(device)
-                        
-                    # Then move entire pipeline
-                    pipe = pipe.to(device)
-                    
-                    # Use original pipeline if None after moving
-                    if pipe is None:
-                        print("Warning: Pipeline.to(device) returned None, using original pipeline")
-                        pipe = original_pipe
-                        
+                    pipe.to(self.device)
                 except Exception as e:
-                    print(f"Warning: Error moving pipeline to device: {e}, using original pipeline")
-                    pipe = original_pipe
+                    print(f"Warning: Error moving pipeline to device: {e}")
                     
                 # Validate pipeline
                 if not callable(pipe):
                     raise RuntimeError("Pipeline is not callable after initialization")
+
+                pipe.model.to(self._PRECISION_DTYPES[model_precision])
+                fp8 = model_precision == "FP8" and self._quantize_fp8(pipe)
+                self._eager_llm = pipe.model.llm
+                self._compiled_llm = self._compile_model(pipe, fp8=fp8)
+                self._compiled_ok = False
                     
                 # Save instance if needed
                 self._model_instance = pipe   
+                self._current_precision = model_precision
                 return pipe
                     
             except Exception as pipe_error:
@@ -249,29 +345,68 @@ class OmniGenInference:
     def generation(self, prompt, num_inference_steps, guidance_scale,
             img_guidance_scale, max_input_image_size, separate_cfg_infer,
             use_input_image_size_as_output, width, height, seed, offload_model=False,
+            model_precision="Auto", kv_cache_dtype="auto",
             input_images=None):
         try:            
-            self._setup_temp_dir()
             use_kv_cache = True
-            if not torch.cuda.is_available():
+            if not _HAS_CUDA:
                 use_kv_cache = False
+            # "auto" stores the cache in FP8 on SM89+, "none"/None keeps it in the compute dtype
+            if kv_cache_dtype == "auto":
+                kv_cache_dtype = "fp8_e4m3" if _HAS_CUDA and _cuda_capability() >= (8, 9) else None
+            elif kv_cache_dtype == "none":
+                kv_cache_dtype = None
             
+            if model_precision == "Auto":
+                model_precision = self._auto_select_precision()
+
             # Check model instance status
-            print(f"Current model instance: {'Present' if self._model_instance else 'None'}")
+            if _LOG_INIT:
+                print(f"Current model instance: {'Present' if self._model_instance else 'None'}")
+                print(f"Current model precision: {self._current_precision}")
+
+            # Drop the cached pipeline if a different precision was requested
+            if self._model_instance and self._current_precision != model_precision:
+                print(f"Switching model precision from {self._current_precision} to {model_precision}")
+                self._model_instance = None
+                self._eager_llm = self._compiled_llm = None
+                self._compiled_ok = False
+                # empty_cache scans every cached block and syncs the device, so it is only
+                # worth paying for here, once the old weights are actually unreferenced
+                gc.collect()
+                self._empty_cache()
             
             final_prompt = prompt.strip()
-            pipe = self._get_pipeline()
+            pipe = self._get_pipeline(model_precision)
             
             # Monitor VRAM usage
-            if torch.cuda.is_available():
+            if _LOG_VRAM:
                 print(f"VRAM usage after pipeline creation: {torch.cuda.memory_allocated()/1024**2:.2f}MB")
             
             # Process prompt and images
-            final_prompt, input_images = self._process_prompt_and_images(final_prompt, input_images)
+            final_prompt, input_images = self._process_prompt_and_images(
+                final_prompt, input_images, max_input_image_size, use_input_image_size_as_output)
             print(f"Processing with prompt: {final_prompt}")
             print(f"Model will be {'offloaded' if offload_model else 'kept'} during generation")
             
-            output = pipe(
+            # Offloading reassigns param.data layer by layer inside the LLM forward, run it eagerly
+            use_compiled = self._compiled_llm is not None and not offload_model
+            pipe.model.llm = self._compiled_llm if use_compiled else self._eager_llm
+
+            # Only the fused flash/memory-efficient attention kernels, no O(N^2) math fallback.
+            # Before SM80 there is no flash attention and the memory-efficient kernel has no bf16,
+            # and MPS/CPU only have the math kernel, so leave the backend choice alone there.
+            if _HAS_CUDA and _cuda_capability() >= (8, 0):
+                attention_ctx = sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+            else:
+                attention_ctx = contextlib.nullcontext()
+            # Let cuDNN autotune the VAE convs, scoped to this call so the rest of the host
+            # process keeps its own settings
+            if _HAS_CUDA:
+                cudnn_ctx = torch.backends.cudnn.flags(enabled=True, benchmark=True, deterministic=False, allow_tf32=True)
+            else:
+                cudnn_ctx = contextlib.nullcontext()
+            pipe_kwargs = dict(
                 prompt=final_prompt,
                 input_images=input_images,
                 guidance_scale=guidance_scale,
@@ -280,16 +415,40 @@ class OmniGenInference:
                 separate_cfg_infer=separate_cfg_infer, 
                 use_kv_cache=use_kv_cache,
                 offload_kv_cache=True,
+                kv_cache_dtype=kv_cache_dtype,
                 offload_model=offload_model,
                 use_input_image_size_as_output=use_input_image_size_as_output,
                 width=width,
                 height=height,
                 seed=seed,
+                dtype=self._PRECISION_DTYPES[model_precision],
                 max_input_image_size=max_input_image_size,
             )
+            # TF32 tensor cores for the remaining fp32 matmuls, restored afterwards for the same reason
+            matmul_precision = torch.get_float32_matmul_precision()
+            if _HAS_CUDA:
+                torch.set_float32_matmul_precision('high')
+            try:
+                with torch.inference_mode(), attention_ctx, cudnn_ctx:
+                    try:
+                        output = pipe(**pipe_kwargs)
+                    except Exception as e:
+                        # torch.compile only builds the graph on the first call, so a missing or
+                        # broken Triton/Inductor toolchain only shows up here
+                        if not use_compiled or self._compiled_ok:
+                            raise
+                        print(f"Warning: compiled model failed ({e}), falling back to eager")
+                        self._compiled_llm = None
+                        pipe.model.llm = self._eager_llm
+                        output = pipe(**pipe_kwargs)
+                    else:
+                        if use_compiled:
+                            self._compiled_ok = True
+            finally:
+                torch.set_float32_matmul_precision(matmul_precision)
             
             # Print VRAM usage after generation
-            if torch.cuda.is_available():
+            if _LOG_VRAM:
                 print(f"VRAM usage after generation: {torch.cuda.memory_allocated()/1024**2:.2f}MB")
             
             return output
@@ -297,8 +456,6 @@ class OmniGenInference:
         except Exception as e:
             print(f"Error during generation: {e}")
             raise e
-        finally:
-            self._cleanup_temp_dir()
 
 
 if __name__ == "__main__":